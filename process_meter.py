@@ -7,6 +7,7 @@ James Gallagher <jgallagher@opendap.org> 4/24/21
 
 
 import argparse
+import struct
 from datetime import datetime, timedelta
 
 
@@ -23,7 +24,7 @@ def main():
     :return: Lines of CSV data
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument("-f", "--file", help="data file to process", default='EM40647_Data.csv')
+    parser.add_argument("-f", "--file", help="data file to process (.csv or .xls)", default='EM40647_Data.csv')
     parser.add_argument("-i", "--interval", help="sample interval (0-60 seconds)", type=int, default=60)
     parser.add_argument("-o", "--offset", help="time offset in seconds", type=int, default=354049200)
     args = parser.parse_args()
@@ -41,47 +42,342 @@ def process_values(data_file, offset, sample_interval):
     where, after the date there are 15 values, five groups of three measurements of
     m³/m³ VWC, °C Temp, mS/cm EC Bulk
 
+    The data can be either a CSV file or the .xls workbook saved by the logger. Both are read
+    as rows of string fields, so the processing is the same.
+
     The timestamps are off on some of the data, so there are two timestamps in the output. The
     first is the original and the second is the result of applying the offset to that time.
     """
 
-    line_num = 0
+    if data_file.lower().endswith('.xls'):
+        rows = read_xls_rows(data_file)
+    else:
+        rows = read_csv_rows(data_file)
+
+    for line_num, fields in enumerate(rows, start=1):
+        if line_num == 1 or line_num == 2:
+            print('blank', *fields, sep=',')
+            continue
+        elif line_num == 3:
+            print('Original Time', *fields, sep=',')
+            continue
+        elif not any(fields):
+            continue    # A blank line or empty row
+
+        msg_time = fields[0]  # parsed time
+        time = msg_time.replace('/', ' ').replace(':', ' ').split()
+        if len(time) != 6:
+            print(f"Failed to parse date for line {line_num}")
+
+        hours = int(time[3])
+        minutes = int(time[4])
+        if minutes % sample_interval == 0:
+            if time[5] == "PM":             # 12 PM == 12, 1 PM == 13
+                if hours < 12:
+                    hours = (hours + 12) % 24
+            else:
+                hours = hours % 12          # 1 AM == 1, 2 AM == 2, ... 12 AM == 0
+
+            time_obj = datetime(int(time[2]), int(time[0]), int(time[1]), hours, minutes)
+            time_offset = timedelta(seconds=offset)
+            new_time = time_obj + time_offset
+            # print(f"Old time: {msg_time}, new time: {new_time}")
+            print(fields[0], new_time, sep=',', end=',')        # ,{fields[1:]}")
+            print(*fields[1:], sep=",")
+
+
+def read_csv_rows(data_file):
+    """
+    Read the METER data from a CSV file.
+
+    :return: A generator of rows, each a list of string fields
+    """
     with open(data_file, "r") as in_file:
+        for line in in_file:
+            yield line.strip().split(",")
+
+
+# The logger saves an Excel 97 (BIFF8) workbook inside an OLE2 compound file. These are the
+# only records read; everything else (fonts, formats, styles, the other sheets) is skipped.
+EOF = 0x000A
+DATEMODE = 0x0022
+BOUNDSHEET = 0x0085
+SST = 0x00FC
+CONTINUE = 0x003C
+LABELSST = 0x00FD
+LABEL = 0x0204
+NUMBER = 0x0203
+RK = 0x027E
+MULRK = 0x00BD
+BOOLERR = 0x0205
+
+XLS_ERRORS = {0x00: '#NULL!', 0x07: '#DIV/0!', 0x0F: '#VALUE!', 0x17: '#REF!', 0x1D: '#NAME?',
+              0x24: '#NUM!', 0x2A: '#N/A'}
+
+# Decimal places the logger uses for each 5TE measurement, keyed by a word in the column heading.
+XLS_DECIMALS = {'VWC': 3, 'Temp': 1, 'EC': 2}
+
+_record_header = struct.Struct('<HH')
+
+
+def read_xls_rows(data_file):
+    """
+    Read the METER data from the .xls workbook saved by the logger.
+
+    Only the first worksheet, which holds the processed data, is read. The three header rows
+    are returned as they are, the 'Measurement Time' column is formatted like the CSV files
+    (e.g., 6/15/2021 3:25 AM) and the 5TE values are rounded to the logger's decimal places.
+
+    :return: A generator of rows, each a list of string fields
+    """
+    with open(data_file, "rb") as in_file:
+        (name, workbook) = _read_ole_stream(in_file.read(), ('Workbook', 'Book'))
+
+    # Excel 5/95 saved a 'Book' stream; its labels are stored differently and it has no SST.
+    if name != 'Workbook':
+        raise ValueError(f"{data_file} is a BIFF5 (Excel 5/95) .xls file, which is not supported")
+
+    # The workbook globals come first; read the shared strings, date system and sheet offsets.
+    sst_chunks = []
+    in_sst = False
+    sheets = []
+    date_base = datetime(1899, 12, 30)
+    pos = 0
+    while pos < len(workbook):
+        (rec_type, length) = _record_header.unpack_from(workbook, pos)
+        data = workbook[pos + 4:pos + 4 + length]
+        pos += 4 + length
+        if rec_type == EOF:
+            break
+        elif rec_type == SST:
+            sst_chunks = [data]
+        elif rec_type == CONTINUE and in_sst:
+            sst_chunks.append(data)
+        elif rec_type == BOUNDSHEET:
+            (sheet_pos, visibility, sheet_type) = struct.unpack_from('<IBB', data)
+            if sheet_type == 0:         # 0 is a worksheet, not a chart or macro sheet
+                sheets.append(sheet_pos)
+        elif rec_type == DATEMODE and struct.unpack_from('<H', data)[0] == 1:
+            date_base = datetime(1904, 1, 1)
+        in_sst = rec_type == SST or (rec_type == CONTINUE and in_sst)
+
+    if not sheets:
+        raise ValueError(f"No worksheet found in {data_file}")
+
+    strings = _read_sst(sst_chunks) if sst_chunks else []
+
+    decimals = {}
+    row_num = 0
+    row = {}
+    pos = sheets[0]
+    while pos < len(workbook):
+        (rec_type, length) = _record_header.unpack_from(workbook, pos)
+        data_pos = pos + 4
+        pos = data_pos + length
+        if rec_type == EOF:
+            break
+
+        if rec_type == LABELSST:
+            (r, c, xf, index) = struct.unpack_from('<HHHI', workbook, data_pos)
+            cells = [(c, strings[index])]
+        elif rec_type == NUMBER:
+            (r, c, xf, value) = struct.unpack_from('<HHHd', workbook, data_pos)
+            cells = [(c, value)]
+        elif rec_type == RK:
+            (r, c, xf, rk) = struct.unpack_from('<HHHi', workbook, data_pos)
+            cells = [(c, _rk_value(rk))]
+        elif rec_type == MULRK:
+            (r, c) = struct.unpack_from('<HH', workbook, data_pos)
+            count = (length - 6) // 6
+            rks = struct.unpack_from('<' + 'Hi' * count, workbook, data_pos + 4)
+            cells = [(c + i, _rk_value(rks[2 * i + 1])) for i in range(count)]
+        elif rec_type == BOOLERR:
+            (r, c, xf, value, is_error) = struct.unpack_from('<HHHBB', workbook, data_pos)
+            cells = [(c, XLS_ERRORS.get(value, '#N/A') if is_error else str(bool(value)).upper())]
+        elif rec_type == LABEL:
+            (r, c, xf, nchars, options) = struct.unpack_from('<HHHHB', workbook, data_pos)
+            encoding = 'utf_16_le' if options & 1 else 'latin_1'
+            size = nchars * 2 if options & 1 else nchars
+            cells = [(c, bytes(workbook[data_pos + 9:data_pos + 9 + size]).decode(encoding))]
+        else:
+            continue        # Formatting, dimensions, blank cells, etc.
+
+        # Cells are stored in row order, so a new row number means the last row is complete.
+        # Empty rows have no cell records; yield them anyway so every row keeps its place.
+        if r != row_num:
+            if row_num == 2:
+                decimals = _xls_decimals(row)
+            yield _xls_row(row, row_num, decimals, date_base)
+            for _ in range(row_num + 1, r):
+                yield []
+            row = {}
+            row_num = r
+        row.update(cells)
+
+    if row:
+        yield _xls_row(row, row_num, decimals, date_base)
+
+
+def _read_ole_stream(contents, names):
+    """
+    Return the named stream from an OLE2 compound file.
+
+    :param contents: The bytes of the file
+    :param names: Return the first stream found with one of these names
+    :return: The name of the stream and the stream as a memoryview
+    """
+    if contents[:8] != b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1':
+        raise ValueError("Not an OLE2 (.xls) file")
+
+    contents = memoryview(contents)
+    sector_size = 1 << struct.unpack_from('<H', contents, 0x1E)[0]
+    (num_fat, first_dir) = struct.unpack_from('<II', contents, 0x2C)
+    mini_sector_size = 1 << struct.unpack_from('<H', contents, 0x20)[0]
+    (mini_cutoff, first_mini_fat) = struct.unpack_from('<II', contents, 0x38)
+    (first_difat, num_difat) = struct.unpack_from('<II', contents, 0x44)
+
+    def sector(sid):
+        start = (sid + 1) * sector_size
+        return contents[start:start + sector_size]
+
+    # The first 109 FAT sector ids are in the header, the rest are in a chain of DIFAT sectors.
+    fat_sids = list(struct.unpack_from('<109I', contents, 0x4C))
+    sid = first_difat
+    for _ in range(num_difat):
+        ids = struct.unpack('<%dI' % (sector_size // 4), sector(sid))
+        fat_sids.extend(ids[:-1])
+        sid = ids[-1]
+    fat = []
+    for sid in fat_sids[:num_fat]:
+        fat.extend(struct.unpack('<%dI' % (sector_size // 4), sector(sid)))
+
+    def chain(sid, table=fat, read=sector):
+        sectors = []
+        while sid < 0xFFFFFFFA:
+            sectors.append(read(sid))
+            sid = table[sid]
+        return b''.join(sectors)
+
+    directory = chain(first_dir)
+    for entry in range(0, len(directory), 128):
+        name_size = struct.unpack_from('<H', directory, entry + 64)[0]
+        name = directory[entry:entry + max(name_size - 2, 0)].decode('utf_16_le')
+        if name in names:
+            (start, size) = struct.unpack_from('<II', directory, entry + 116)
+            if size >= mini_cutoff:
+                return name, memoryview(chain(start))[:size]
+
+            # Small streams (a short export) are kept in 64 byte sectors inside the mini stream,
+            # which is stored like any other stream starting at the root (first) directory entry.
+            mini_stream = chain(struct.unpack_from('<I', directory, 116)[0])
+            mini_fat_data = chain(first_mini_fat)
+            mini_fat = struct.unpack('<%dI' % (len(mini_fat_data) // 4), mini_fat_data)
+
+            def mini_sector(sid):
+                return mini_stream[sid * mini_sector_size:(sid + 1) * mini_sector_size]
+
+            return name, memoryview(chain(start, mini_fat, mini_sector))[:size]
+
+    raise ValueError("No workbook stream found")
+
+
+def _read_sst(chunks):
+    """
+    Read the shared string table.
+
+    :param chunks: The data of the SST record and its CONTINUE records. A string's characters
+    can be split across records; each CONTINUE then starts with a new option byte.
+    :return: The list of strings
+    """
+    chunk_num = 0
+    data = chunks[0]
+    count = struct.unpack_from('<I', data, 4)[0]
+    pos = 8
+    strings = []
+    for _ in range(count):
+        if pos >= len(data):
+            chunk_num += 1
+            data = chunks[chunk_num]
+            pos = 0
+        (nchars, options) = struct.unpack_from('<HB', data, pos)
+        pos += 3
+        skip = 0
+        if options & 0x08:      # rich text formatting runs
+            skip += 4 * struct.unpack_from('<H', data, pos)[0]
+            pos += 2
+        if options & 0x04:      # phonetic (Asian) data
+            skip += struct.unpack_from('<I', data, pos)[0]
+            pos += 4
+
+        parts = []
         while True:
-            line = in_file.readline()
-            line_num += 1
-            if not line:
-                break  # This is the loop exit
-
-            if line_num == 1 or line_num == 2:
-                print('blank', line, end='', sep=',')
-                continue
-            elif line_num == 3:
-                print('Original Time', line, end='', sep=',')
-                continue
-
-            fields = line.strip().split(",")
-
-            msg_time = fields[0]  # parsed time
-            time = msg_time.replace('/', ' ').replace(':', ' ').split()
-            if len(time) != 6:
-                print(f"Failed to parse date for line {line_num}")
-
-            hours = int(time[3])
-            minutes = int(time[4])
-            if minutes % sample_interval == 0:
-                if time[5] == "PM":             # 12 PM == 12, 1 PM == 13
-                    if hours < 12:
-                        hours = (hours + 12) % 24
-                else:
-                    hours = hours % 12          # 1 AM == 1, 2 AM == 2, ... 12 AM == 0
-
-                time_obj = datetime(int(time[2]), int(time[0]), int(time[1]), hours, minutes)
-                time_offset = timedelta(seconds=offset)
-                new_time = time_obj + time_offset
-                # print(f"Old time: {msg_time}, new time: {new_time}")
-                print(fields[0], new_time, sep=',', end=',')        # ,{fields[1:]}")
-                print(*fields[1:], sep=",")
+            width = 2 if options & 0x01 else 1
+            take = min(nchars, (len(data) - pos) // width)
+            parts.append(bytes(data[pos:pos + take * width]).decode('utf_16_le' if width == 2 else 'latin_1'))
+            pos += take * width
+            nchars -= take
+            if not nchars:
+                break
+            chunk_num += 1
+            data = chunks[chunk_num]
+            options = data[0]
+            pos = 1
+        strings.append(''.join(parts))
+
+        pos += skip
+        while pos > len(data):
+            pos -= len(data)
+            chunk_num += 1
+            data = chunks[chunk_num]
+
+    return strings
+
+
+def _rk_value(rk):
+    """
+    Decode an RK value, a compressed IEEE double or integer, optionally scaled by 100.
+    """
+    if rk & 0x02:
+        value = rk >> 2
+    else:
+        value = struct.unpack('<d', struct.pack('<Q', (rk & 0xFFFFFFFC) << 32))[0]
+    if rk & 0x01:
+        value /= 100.0
+    return value
+
+
+def _xls_decimals(header_row):
+    """
+    Map columns to decimal places using the 'm³/m³ VWC', '°C Temp', 'mS/cm EC Bulk' headings.
+    """
+    decimals = {}
+    for (col, heading) in header_row.items():
+        for word in str(heading).split():
+            if word in XLS_DECIMALS:
+                decimals[col] = XLS_DECIMALS[word]
+    return decimals
+
+
+def _xls_row(row, row_num, decimals, date_base):
+    """
+    Convert a row of cells to string fields like those in the CSV files.
+    """
+    if not row:
+        return []
+    fields = [''] * (max(row) + 1)
+    for (col, value) in row.items():
+        if isinstance(value, str):
+            fields[col] = value
+        elif col == 0 and row_num > 2:
+            # Measurement Time is a day number; round to the second to undo the float error.
+            time = date_base + timedelta(seconds=round(value * 86400))
+            fields[col] = f"{time.month}/{time.day}/{time.year} {(time.hour + 11) % 12 + 1}:{time.minute:02d} " \
+                          f"{'PM' if time.hour >= 12 else 'AM'}"
+        elif col in decimals:
+            fields[col] = f"{round(value, decimals[col]) + 0.0:.{decimals[col]}f}"     # + 0.0 drops '-0.000'
+        else:
+            fields[col] = f"{value:g}"
+    return fields
 
 
 if __name__ == "__main__":
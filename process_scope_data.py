@@ -10,12 +10,18 @@ This is old has been replaced by a Jupyter notebook.
 """
 
 import argparse
+import os
+import tempfile
+from multiprocessing import Pool, cpu_count
 import numpy as np
-from scipy.signal import butter, sosfilt
+from scipy.signal import butter, sosfilt, welch
 import plotly.graph_objects as go
 import plotly.express as px
 
 # For the 23dBm file, -d 000005 and -o 0.0; for the 13dBm file, -d 0.00001 -o 0.0765
+# Use -w sweep with the same -d and -o to rank cutoff, order and threshold values (e.g.,
+# -c 250,500,1000 -n 2,4 -t 0.0001,0.0002), then
+# -w filter --cutoff <Hz> --order <N> -z <V> to use the best of them.
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--interval", help="read every Xth value, ignored for 'filter'", default=1000, type=int)
@@ -24,22 +30,36 @@ def main():
     parser.add_argument("-r", "--resistance", help="Resistance used in measurement", default=2.2, type=float)
     parser.add_argument("-d", "--delta_t", help="Sample time period", default=0.000005, type=float)
     parser.add_argument("-o", "--offset", help="Voltage offset", default=0.0, type=float)
-    parser.add_argument("-w", "--what", help="Do what: print or filter data", default='print')
+    parser.add_argument("-w", "--what", help="Do what: print, filter or sweep data", default='print')
     parser.add_argument("-p", "--plot", help="Plot the raw and filtered data", default=False, type=bool)
     parser.add_argument("-R", "--raw", help="Plot raw data too", default=False, type=bool)
+    parser.add_argument("--cutoff", help="Low pass filter cutoff frequency (Hz) for 'filter'", default=1000.0,
+                        type=float)
+    parser.add_argument("--order", help="Low pass filter order for 'filter'", default=4, type=int)
+    parser.add_argument("-c", "--cutoffs", help="Comma separated cutoff frequencies (Hz) to try for 'sweep'",
+                        default=[250.0, 500.0, 1000.0, 2000.0, 4000.0], type=lambda s: [float(x) for x in s.split(',')])
+    parser.add_argument("-n", "--orders", help="Comma separated filter orders to try for 'sweep'",
+                        default=[2, 4, 6, 8], type=lambda s: [int(x) for x in s.split(',')])
+    parser.add_argument("-t", "--thresholds", help="Comma separated zero thresholds (V) to try for 'sweep'",
+                        default=[0.00005, 0.0001, 0.00015, 0.0002, 0.0003],
+                        type=lambda s: [float(x) for x in s.split(',')])
+    parser.add_argument("-j", "--jobs", help="Number of processes for 'sweep'", default=cpu_count(), type=int)
+    parser.add_argument("-b", "--noise_band", help="Lower edge (Hz) of the noise band for 'sweep'",
+                        default=10000.0, type=float)
+    parser.add_argument("-a", "--min_attenuation", help="Least noise floor attenuation (dB) to pass 'sweep'",
+                        default=20.0, type=float)
+    parser.add_argument("-T", "--top", help="Number of ranked results to print for 'sweep'", default=10, type=int)
     parser.add_argument('data_file', help='Read from this file')
     args = parser.parse_args()
 
     if args.what == 'print':
         print_values_from_siglent_csv(args.data_file, args.zero, args.skip, args.interval)
     elif args.what == 'filter':
-        # Filter requirements.
-        # T = 14.0  # Sample Period, seconds
-        fs = 100000.0  # sample rate, Hz
-        cutoff = 1000.0  # desired cutoff frequency of the filter, Hz
-        # nyq = 0.5 * fs  # Nyquist Frequency
-        order = 4
-        # n = int(T * fs)  # total number of samples
+        # Filter requirements. The sample rate comes from the sample period, as for 'sweep',
+        # so the cutoff and order it recommends can be used here as they are.
+        fs = 1.0 / args.delta_t  # sample rate, Hz
+        cutoff = args.cutoff  # desired cutoff frequency of the filter, Hz
+        order = args.order
 
         # data_file could be '/Users/jimg/src/opendap/HAST_leaf_node_data/Current_measurement/LN_Current_13dBm_23dBm/13dBm_current.csv'
 
@@ -94,6 +114,10 @@ def main():
             fig.show(title="Leaf node current use during the operating phase")
 
         calc_values_from_filtered_data(filtered_volts, args.zero, args.delta_t, args.resistance)
+    elif args.what == 'sweep':
+        sweep_filter_parameters(args.data_file, args.skip, args.offset, args.resistance, args.delta_t,
+                                args.cutoffs, args.orders, args.thresholds, args.noise_band, args.min_attenuation,
+                                args.jobs, args.top)
     else:
         args.usage()
 
@@ -107,6 +131,166 @@ def butter_lowpass_filter(data, cutoff, fs, order):
     return y
 
 
+# Each worker process gets its own read-only view of the memory-mapped voltages. This is
+# set by _init_sweep_worker() so the capture is not pickled and copied for every task.
+_sweep_volts = None
+
+
+def _init_sweep_worker(volts_file):
+    global _sweep_volts
+    _sweep_volts = np.load(volts_file, mmap_mode='r')
+
+
+def noise_floor(data, fs, noise_band):
+    """
+    @param data The signal to examine
+    @param fs The sampling frequency
+    @param noise_band Frequencies (Hz) at or above this are treated as noise
+    @return The median Welch PSD (V^2/Hz) in the noise band
+    """
+    freqs, psd = welch(data, fs=fs, nperseg=4096)
+    return np.median(psd[freqs >= noise_band])
+
+
+def charge_edges(data, delta_t, edge=0.005):
+    """
+    Find when the current starts and stops using the cumulative charge. This is not thrown
+    off by noise in the raw data, so the raw and filtered data can be compared the same way.
+
+    @param data The signal to examine
+    @param delta_t The duration of each sample
+    @param edge The fraction of the total charge that marks the start and the end
+    @return The start and end times in seconds
+    """
+    charge = np.cumsum(data)
+    start = np.searchsorted(charge, edge * charge[-1])
+    end = np.searchsorted(charge, (1.0 - edge) * charge[-1])
+    return start * delta_t, end * delta_t
+
+
+def _score_filter(task):
+    """
+    Filter the shared capture once for a cutoff/order pair and score every threshold.
+
+    @param task Tuple of cutoff, order, thresholds, fs, delta_t, resistance, noise_band,
+    raw charge (mAs), raw noise floor (V^2/Hz), raw start and end times (s) and the number
+    of quiet samples before the first burst
+    @return A list of (cutoff, order, threshold, noise mA, attenuation dB, charge error %,
+    timing error ms)
+    """
+    (cutoff, order, thresholds, fs, delta_t, resistance, noise_band, raw_mAs, raw_floor,
+     raw_start, raw_end, quiet) = task
+
+    filtered_volts = butter_lowpass_filter(_sweep_volts, cutoff, fs, order)
+
+    # Low cutoffs lower the noise but delay and blur the edges of the bursts, which sets the
+    # start, end and total times. Compare the edges with those of the raw data. The filtered
+    # data are used before the threshold so that both have the same zero mean noise.
+    (start, end) = charge_edges(filtered_volts, delta_t)
+    timing_error = (abs(start - raw_start) + abs(end - raw_end)) * 1000.0
+
+    results = []
+    for threshold in thresholds:
+        zeroed = filtered_volts < threshold
+        thresholded_volts = np.where(zeroed, 0.0, filtered_volts)
+
+        # Residual noise is what is left in the output while the node is known to be asleep.
+        # The filter is causal, so none of the first burst leaks into this window.
+        noise_mA = np.sqrt(np.mean(thresholded_volts[:quiet] ** 2)) / resistance * 1000.0
+
+        # The noise is (close to) zero mean, so the raw capture is the reference for the charge.
+        mAs = np.sum(thresholded_volts) * delta_t / resistance * 1000.0
+        charge_error = abs(mAs - raw_mAs) / abs(raw_mAs) * 100.0 if raw_mAs != 0.0 else 0.0
+
+        floor = noise_floor(thresholded_volts, fs, noise_band)
+        attenuation = 10.0 * np.log10(raw_floor / floor) if floor > 0.0 else np.inf
+
+        results.append((cutoff, order, threshold, noise_mA, attenuation, charge_error, timing_error))
+
+    return results
+
+
+def sweep_filter_parameters(data_file, skip, offset, resistance, delta_t, cutoffs, orders, thresholds,
+                            noise_band, min_attenuation, jobs, top):
+    """
+    Try every combination of cutoff, order and threshold and print them ranked, best first.
+
+    The voltages are written to a temporary .npy file that each worker memory-maps, so the
+    capture is read from the CSV once. Each task filters the capture for one cutoff/order
+    pair and then scores all of the thresholds against that filtered signal.
+
+    Each candidate is scored by the sum of three errors, each a percentage of what it should
+    be: the residual noise (mA) in the output before the first burst relative to the mean
+    current during the bursts, the error in the total charge and the error in the start and
+    end times relative to the length of the bursts. Lower cutoffs reduce the first and blur
+    the last. Candidates that do not lower the Welch PSD noise floor above 'noise_band' by at
+    least 'min_attenuation' dB are ranked after all of those that do.
+
+    @param data_file The oscilloscope CSV file
+    @param skip Skip this many header lines
+    @param offset Voltage offset
+    @param resistance Used to convert volts to mA
+    @param delta_t The duration of each sample
+    @param cutoffs, orders, thresholds The values to try
+    @param noise_band Frequencies (Hz) at or above this are treated as noise
+    @param min_attenuation The least attenuation (dB) of the noise floor to pass
+    @param jobs Number of worker processes
+    @param top Print this many of the ranked results
+    """
+    fs = 1.0 / delta_t
+    if noise_band >= fs / 2.0:
+        raise ValueError(f"The noise band ({noise_band}Hz) must be below the Nyquist frequency ({fs / 2.0}Hz)")
+
+    skipped = [cutoff for cutoff in cutoffs if cutoff >= fs / 2.0]
+    cutoffs = [cutoff for cutoff in cutoffs if cutoff < fs / 2.0]
+    if not cutoffs:
+        raise ValueError(f"No cutoff frequency is below the Nyquist frequency ({fs / 2.0}Hz)")
+    if skipped:
+        print(f"Skipping cutoff frequencies at or above the Nyquist frequency ({fs / 2.0}Hz): {skipped}")
+
+    data = np.genfromtxt(data_file, delimiter=',', skip_header=skip)
+    voltages = data[..., 1] + offset
+
+    raw_mAs = np.sum(voltages) * delta_t / resistance * 1000.0
+    raw_floor = noise_floor(voltages, fs, noise_band)
+
+    # Use the samples up to 1% of the burst length before the first one as the quiet window.
+    (raw_start, raw_end) = charge_edges(voltages, delta_t)
+    quiet = int((raw_start - 0.01 * (raw_end - raw_start)) / delta_t)
+    if quiet <= 0:
+        raise ValueError("The capture needs some time with the node asleep before the first burst")
+
+    tasks = [(cutoff, order, thresholds, fs, delta_t, resistance, noise_band, raw_mAs, raw_floor,
+              raw_start, raw_end, quiet)
+             for cutoff in cutoffs for order in orders]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        volts_file = os.path.join(tmp_dir, "voltages.npy")
+        np.save(volts_file, voltages)
+        del data, voltages
+
+        with Pool(processes=jobs, initializer=_init_sweep_worker, initargs=(volts_file,)) as pool:
+            results = [result for results in pool.map(_score_filter, tasks) for result in results]
+
+    burst_time = raw_end - raw_start
+    burst_mA = raw_mAs / burst_time
+    scores = [result[3] / burst_mA * 100.0 + result[5] + result[6] / 1000.0 / burst_time * 100.0
+              for result in results]
+    best = sorted(range(len(results)), key=lambda i: (results[i][4] < min_attenuation, scores[i]))
+
+    print(f"Raw charge: {raw_mAs:.3f}mAs, raw noise floor: {raw_floor:.3e}V^2/Hz, "
+          f"start time: {raw_start:.4f}s, end time: {raw_end:.4f}s")
+    print("Rank, Cutoff (Hz), Order, Threshold (V), Noise (mA), Attenuation (dB), Charge error (%), "
+          "Timing error (ms), Score (%)")
+    for rank, i in enumerate(best[:top], start=1):
+        (cutoff, order, threshold, noise_mA, attenuation, charge_error, timing_error) = results[i]
+        print(f"{rank},{cutoff:.0f},{order},{threshold},{noise_mA:.4f},{attenuation:.1f},{charge_error:.3f},"
+              f"{timing_error:.3f},{scores[i]:.3f}")
+
+    (cutoff, order, threshold) = results[best[0]][:3]
+    print(f"\nUse: -w filter -d {delta_t} -o {offset} --cutoff {cutoff:.0f} --order {order} -z {threshold}")
+
+
 def print_values_from_siglent_csv(data_file, zero_value, skip, sample_interval):
     print("Seconds, Volts")
     with open(data_file, "r") as in_file: